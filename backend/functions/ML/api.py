@@ -1,29 +1,85 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import Optional, List, Tuple
+import contextvars
+import json
 import os
+import time
 import torch
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
 from dict_matcher import match_query_or_none
-from dictionary import KEYWORD_TO_TAGS
+from dictionary import DICT_VERSION, KEYWORD_TO_TAGS
+from json_responses import (
+    ANALYZE_ERROR_BODY,
+    RawJSONResponse,
+    encode_json,
+    prebuilt_body_count,
+    search_terms_response,
+)
+from latency_budget import (
+    COSTS,
+    InferenceQueue,
+    LatencyBudget,
+    budget_scope,
+    count_degraded_response,
+    current_budget,
+    degraded_stats,
+    measure_stage,
+    parse_budget_ms,
+)
+from ner_extractor import ner_model_version
 from query_normalizer import extract_query_entities, normalize_text
+from request_log import dropped_log_records, get_logger, log_request, new_request_id
+from runtime_config import apply_torch_threads
+from shared_cache import create_shared_cache
+from stage_trace import TRACE_ENABLED, parse_trace_flag, profiled, stage, tracing
 
 
 app = FastAPI(title="OSM Tagging API")
+logger = get_logger("api")
+
+# ワーカーあたりの torch スレッド数（tune_topology.py の推奨値 / 環境変数）
+_TOPOLOGY = apply_torch_threads(torch)
 
 # Transformer classifier cache
 _TR_MODEL = None
 _TR_TOKENIZER = None
 _TR_MODEL_DIR: Optional[str] = None
 _TR_DEVICE: Optional[str] = None
+_TR_VERSION: Optional[str] = None
+
+# ワーカー間共有の結果キャッシュ（SHARED_CACHE_URL 未設定なら None）
+_SHARED_CACHE = create_shared_cache()
+
+# Transformer 推論の同時実行枠（待ち件数をレイテンシ予算の見積もりに使う）。
+# 共有の HF fast tokenizer はスレッドセーフではない（"Already borrowed"）ので 1 に固定する。
+# 並列度はワーカー数と torch の intra-op スレッド数で調整する（tune_topology.py）。
+_TR_QUEUE = InferenceQueue(1)
 
 class AnalyzeReq(BaseModel):
     query: str
 
+def _model_version(model_dir: str) -> str:
+    """モデルディレクトリのパスとファイル更新時刻（および NER の版）から版を作る。"""
+    mtimes = []
+    for name in sorted(os.listdir(model_dir)):
+        path = os.path.join(model_dir, name)
+        if os.path.isfile(path):
+            mtimes.append(f"{name}:{os.path.getmtime(path):.0f}")
+    # 出力を左右する閾値も版に含める
+    thresholds = ",".join(
+        os.environ.get(k, "")
+        for k in ("TRANSFORMER_MIN_CONF", "TRANSFORMER_SECOND_MIN_CONF", "TRANSFORMER_SECOND_REL_MIN")
+    )
+    # 前処理の NER もモデル・閾値が変われば Transformer への入力が変わる
+    return f"{model_dir}|{','.join(mtimes)}|{thresholds}|ner={ner_model_version()}"
+
+
 def _load_transformer():
-    global _TR_MODEL, _TR_TOKENIZER, _TR_MODEL_DIR, _TR_DEVICE
+    global _TR_MODEL, _TR_TOKENIZER, _TR_MODEL_DIR, _TR_DEVICE, _TR_VERSION
     if _TR_MODEL is not None and _TR_TOKENIZER is not None:
         return _TR_MODEL, _TR_TOKENIZER
 
@@ -43,9 +99,12 @@ def _load_transformer():
         _TR_MODEL = model
         _TR_MODEL_DIR = model_dir
         _TR_DEVICE = device
+        _TR_VERSION = _model_version(model_dir)
+        if _SHARED_CACHE is not None:
+            _SHARED_CACHE.set_versions(_TR_VERSION, DICT_VERSION)
         return _TR_MODEL, _TR_TOKENIZER
     except Exception as e:
-        print("[TR] load failed:", e)
+        logger.error("transformer load failed", extra={"fields": {"model_dir": model_dir, "error": str(e)}})
         _TR_MODEL = None
         _TR_TOKENIZER = None
         return None, None
@@ -69,28 +128,66 @@ def _predict_labels(query: str, top_k: int = 2) -> List[Tuple[str, float]]:
     if model is None or tokenizer is None:
         return []
 
-    text = _preprocess_query_for_transformer(query)
+    with stage("preprocess"):
+        text = _preprocess_query_for_transformer(query)
     if not text:
         return []
 
     device = _TR_DEVICE or ("cuda" if torch.cuda.is_available() else "cpu")
     with torch.no_grad():
-        encoded = tokenizer(text, truncation=True, padding=True, max_length=128, return_tensors="pt")
+        with stage("tokenizer"):
+            encoded = tokenizer(text, truncation=True, padding=True, max_length=128, return_tensors="pt")
+            encoded = {k: v.to(device) for k, v in encoded.items()}
+        with stage("forward"):
+            logits = model(**encoded).logits
+        with stage("label_resolution"):
+            probs = torch.softmax(logits, dim=-1).squeeze(0)
+
+            k = min(max(1, top_k), probs.shape[-1])
+            values, indices = torch.topk(probs, k=k)
+
+            id2label = getattr(model.config, "id2label", {}) or {}
+            out: List[Tuple[str, float]] = []
+            for score, idx in zip(values.tolist(), indices.tolist()):
+                label = id2label.get(idx)
+                if label is None:
+                    label = id2label.get(str(idx), str(idx))
+                out.append((str(label), float(score)))
+        return out
+
+
+def _predict_labels_batch(queries: List[str], top_k: int = 2) -> List[List[Tuple[str, float]]]:
+    """`_predict_labels` のバッチ版。1 回の forward で複数クエリを推論する。"""
+    model, tokenizer = _load_transformer()
+    if model is None or tokenizer is None:
+        return [[] for _ in queries]
+
+    texts = [_preprocess_query_for_transformer(q) for q in queries]
+    idx_map = [i for i, t in enumerate(texts) if t]
+    results: List[List[Tuple[str, float]]] = [[] for _ in queries]
+    if not idx_map:
+        return results
+
+    device = _TR_DEVICE or ("cuda" if torch.cuda.is_available() else "cpu")
+    with torch.no_grad():
+        encoded = tokenizer([texts[i] for i in idx_map], truncation=True, padding=True, max_length=128, return_tensors="pt")
         encoded = {k: v.to(device) for k, v in encoded.items()}
         logits = model(**encoded).logits
-        probs = torch.softmax(logits, dim=-1).squeeze(0)
+        probs = torch.softmax(logits, dim=-1)
 
         k = min(max(1, top_k), probs.shape[-1])
-        values, indices = torch.topk(probs, k=k)
+        values, indices = torch.topk(probs, k=k, dim=-1)
 
         id2label = getattr(model.config, "id2label", {}) or {}
-        out: List[Tuple[str, float]] = []
-        for score, idx in zip(values.tolist(), indices.tolist()):
-            label = id2label.get(idx)
-            if label is None:
-                label = id2label.get(str(idx), str(idx))
-            out.append((str(label), float(score)))
-        return out
+        for row, qi in enumerate(idx_map):
+            out: List[Tuple[str, float]] = []
+            for score, idx in zip(values[row].tolist(), indices[row].tolist()):
+                label = id2label.get(idx)
+                if label is None:
+                    label = id2label.get(str(idx), str(idx))
+                out.append((str(label), float(score)))
+            results[qi] = out
+    return results
 
 
 def _filter_top_predictions(preds: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
@@ -134,10 +231,21 @@ def status():
         "transformer_model_dir": _TR_MODEL_DIR,
         "transformer_device": _TR_DEVICE,
         "cuda_available": _cuda_available(),
+        "torch_num_threads": torch.get_num_threads(),
+        "torch_num_interop_threads": torch.get_num_interop_threads(),
+        "topology": _TOPOLOGY,
         "min_conf": float(os.environ.get("TRANSFORMER_MIN_CONF", "0.30")),
         "second_min_conf": float(os.environ.get("TRANSFORMER_SECOND_MIN_CONF", "0.20")),
         "second_rel_min": float(os.environ.get("TRANSFORMER_SECOND_REL_MIN", "0.70")),
         "dict_entries": len(KEYWORD_TO_TAGS),
+        "prebuilt_responses": prebuilt_body_count(),
+        "trace_enabled": TRACE_ENABLED,
+        "shared_cache": type(_SHARED_CACHE.backend).__name__ if _SHARED_CACHE is not None else None,
+        "dict_version": DICT_VERSION,
+        "latency_budget_ms": parse_budget_ms(None),
+        "transformer_queue": {"waiting": _TR_QUEUE.waiting, "active": _TR_QUEUE.active},
+        "degraded": degraded_stats(),
+        "dropped_log_records": dropped_log_records(),
     }
 
 
@@ -161,40 +269,163 @@ def reload_transformer():
 def reload_embeddings_compat():
     return reload_transformer()
 
-@app.post("/api/v1/analyze-keywords")
-async def analyze(req: AnalyzeReq):
-    """キーワードを解析して、検索クエリとカテゴリを返す"""
-    print("--- 受信したリクエストボディ ---")
-    print(req)
-    query = req.query
+def _analyze_error() -> RawJSONResponse:
+    return RawJSONResponse(status_code=400, content=ANALYZE_ERROR_BODY)
+
+
+def _mark_degraded(response: RawJSONResponse, budget: LatencyBudget) -> RawJSONResponse:
+    """縮退した応答に `degraded` フラグを付ける（事前エンコード済み本体は作り直す）。"""
+    content = json.loads(response.body)
+    content["degraded"] = True
+    content["degraded_reasons"] = list(budget.degraded)
+    count_degraded_response()
+    marked = RawJSONResponse(status_code=response.status_code, content=encode_json(content))
+    marked.headers["X-Degraded"] = "1"
+    return marked
 
+
+async def _analyze_query(query: str, info: dict) -> RawJSONResponse:
     if not query:
-        return JSONResponse(status_code=400, content={"error":{"code":400,"message":"解析不能なキーワードです。"}})
+        info["tier"] = "empty"
+        return _analyze_error()
 
     # 1) 辞書優先 (top_k=2 に固定)
-    hit = match_query_or_none(query, top_k=2)
+    with stage("match_query"):
+        hit = match_query_or_none(query, top_k=2)
     if hit:
-        return {"searchTerms": hit}
-
-    # 2) Transformer 分類器
-    preds = _predict_labels(query, top_k=2)
+        info["tier"] = "dictionary"
+        return search_terms_response(hit)
+
+    # 2) ワーカー間共有キャッシュ（キーはモデル/辞書の版を含むので読み込み後に参照）。
+    # モデルの読み込みはここでは行わず、Transformer 段（スレッドプール）に任せる
+    if _SHARED_CACHE is not None and _TR_VERSION is not None:
+        # SQLite / Redis へのアクセスでイベントループを止めないようスレッドプールで行う
+        with stage("shared_cache"):
+            cached = await run_in_threadpool(_SHARED_CACHE.get, query)
+        if cached is not None:
+            info["tier"] = "shared_cache"
+            status_code, body = cached
+            return RawJSONResponse(status_code=status_code, content=body)
+
+    response = await _run_transformer_tier(query, info)
+    budget = current_budget()
+    degraded = budget is not None and budget.degraded
+    # 初回リクエストで読み込まれた場合もここで版が確定しているので保存できる
+    if _SHARED_CACHE is not None and _TR_VERSION is not None and not degraded and "error" not in info:
+        await run_in_threadpool(_SHARED_CACHE.set, query, response.status_code, response.body)
+    return response
+
+
+async def _run_transformer_tier(query: str, info: dict) -> RawJSONResponse:
+    """Transformer 段を予算・待ち行列と照らし合わせて実行する。
+
+    推論はスレッドプールで行い、辞書ヒットのリクエストが推論の後ろで待たないようにする。
+    予算内に終わらない見込みなら実行せず、辞書段の結果（未ヒット）を縮退として返す。
+    """
+    budget = current_budget()
+    if budget is not None:
+        wait_ms = _TR_QUEUE.estimated_wait_ms() or 0.0
+        if not budget.can_afford("transformer", extra_wait_ms=wait_ms):
+            info["tier"] = "transformer"
+            budget.mark_degraded("transformer_skipped")
+            return _analyze_error()
+
+    timeout_s = None
+    if budget is not None:
+        cost_ms = COSTS.estimate("transformer") or 0.0
+        timeout_s = (budget.remaining_ms() - cost_ms) / 1000.0
+    if not await _TR_QUEUE.acquire(timeout_s=timeout_s):
+        # timeout_s を指定するのは予算があるときだけ
+        info["tier"] = "transformer"
+        budget.mark_degraded("transformer_queue_timeout")
+        return _analyze_error()
+    try:
+        ctx = contextvars.copy_context()
+        return await run_in_threadpool(ctx.run, _timed_transformer, query, info)
+    finally:
+        _TR_QUEUE.release()
+
+
+def _timed_transformer(query: str, info: dict) -> RawJSONResponse:
+    # 初回のモデル読み込みは見積もりに含めない。読み込めなければ推論せずに返し、
+    # 一瞬で終わる失敗を見積もり（COSTS）に反映しない
+    if _load_transformer()[0] is None:
+        info["tier"] = "transformer"
+        return _analyze_error()
+    # 実行すると決めた後なので、内部の前処理/辞書再照合（NER を含む）には予算を適用しない
+    with budget_scope(None), profiled(), measure_stage("transformer"):
+        return _analyze_by_transformer(query, info)
+
+
+def _analyze_by_transformer(query: str, info: dict) -> RawJSONResponse:
+    # 3) Transformer 分類器
+    info["tier"] = "transformer"
+    with stage("transformer"):
+        preds = _predict_labels(query, top_k=2)
     preds = _filter_top_predictions(preds)
     if not preds:
-        return JSONResponse(status_code=400, content={"error":{"code":400,"message":"解析不能なキーワードです。"}})
+        return _analyze_error()
 
     try:
         for raw_label, score in preds:
             for term in (raw_label,):
-                hit2 = match_query_or_none(term, top_k=2)
+                with stage("match_label", label=raw_label):
+                    hit2 = match_query_or_none(term, top_k=2)
                 if hit2:
-                    return {
+                    info["predicted_label"] = raw_label
+                    info["score"] = score
+                    return RawJSONResponse(content=encode_json({
                         "searchTerms": hit2,
                         "predicted_label": raw_label,
                         "matched_term": term,
                         "score": score,
                         "model_type": "transformer",
-                    }
+                    }))
     except Exception as e:
-        print("[TR] inference failed:", e)
+        info["error"] = str(e)
+        logger.exception("transformer inference failed", extra={"fields": {"request_id": info.get("request_id")}})
+
+    return _analyze_error()
+
+
+async def _analyze_query_traced(query: str, info: dict, mode: str) -> RawJSONResponse:
+    """ステージ計測付きで解析し、レスポンス本体に `debug_trace` を添付する。"""
+    with tracing(profile=(mode == "profile")) as trace:
+        response = await _analyze_query(query, info)
+    content = json.loads(response.body)
+    content["debug_trace"] = trace.to_dict()
+    return RawJSONResponse(status_code=response.status_code, content=encode_json(content))
 
-    return JSONResponse(status_code=400, content={"error":{"code":400,"message":"解析不能なキーワードです。"}})
\ No newline at end of file
+
+@app.post("/api/v1/analyze-keywords", response_class=RawJSONResponse)
+async def analyze(
+    req: AnalyzeReq,
+    x_request_id: Optional[str] = Header(default=None),
+    x_debug_trace: Optional[str] = Header(default=None),
+    x_latency_budget_ms: Optional[str] = Header(default=None),
+    trace: Optional[str] = Query(default=None),
+):
+    """キーワードを解析して、検索クエリとカテゴリを返す"""
+    t0 = time.perf_counter()
+    request_id = new_request_id(x_request_id)
+    info: dict = {"request_id": request_id}
+    status_code = 500
+    budget_ms = parse_budget_ms(x_latency_budget_ms)
+    budget = LatencyBudget(budget_ms, start=t0) if budget_ms is not None else None
+    try:
+        with budget_scope(budget):
+            trace_mode = parse_trace_flag(x_debug_trace or trace)
+            if trace_mode:
+                response = await _analyze_query_traced(req.query, info, trace_mode)
+            else:
+                response = await _analyze_query(req.query, info)
+        if budget is not None and budget.degraded:
+            info["degraded"] = list(budget.degraded)
+            response = _mark_degraded(response, budget)
+        status_code = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        latency_ms = (time.perf_counter() - t0) * 1000.0
+        info.pop("request_id", None)
+        log_request(request_id, req.query, status_code, latency_ms, **info)
@@ -13,6 +13,7 @@ from __future__ import annotations
 from typing import Optional, List, Dict
 from dictionary import KEYWORD_TO_TAGS
 from query_normalizer import extract_query_entities, normalize_text as normalize_query_text
+from stage_trace import note, stage
 
 
 def normalize_text(s: str) -> str:
@@ -53,10 +54,14 @@ def match_query(query: str, top_k: int = 2) -> List[Dict]:
         candidates.append(stripped)
 
     tags = None
-    for c in candidates:
-        tags = KEYWORD_TO_TAGS.get(c)
-        if tags:
-            break
+    matched = None
+    with stage("dictionary"):
+        for c in candidates:
+            tags = KEYWORD_TO_TAGS.get(c)
+            if tags:
+                matched = c
+                break
+    note("dictionary_candidates", candidates=candidates, matched=matched, brands=ent.brands)
 
     # ヒットしたら、ブランド由来の補助タグも付与
     if tags and ent.brand_tags:
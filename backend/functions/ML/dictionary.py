@@ -16,18 +16,26 @@
 
 from __future__ import annotations
 from pathlib import Path
-import csv, json
+import csv, hashlib, json
 
 # 同ディレクトリに置く CSV（UTF-8/BOM 可）
 DICT_CSV_PATH = Path(__file__).with_name("osm_dictionary.csv")
 
+def tags_key(tags: list[dict]) -> tuple[tuple[str, str], ...]:
+    """タグ配列を (key, value) のタプル列に変換する。同一タグ集合の識別子として使う。"""
+    return tuple((t.get("key"), t.get("value")) for t in tags)
+
+
 def load_keyword_to_tags(csv_path: Path = DICT_CSV_PATH) -> dict[str, list[dict]]:
     """
     CSV 形式:
       text,tags
       カフェ,"[{""key"": ""amenity"", ""value"": ""cafe""}]"
+
+    同一のタグ集合は 1 つのリストオブジェクトに集約（intern）して共有します。
     """
     mapping: dict[str, list[dict]] = {}
+    interned: dict[tuple[tuple[str, str], ...], list[dict]] = {}
     if not csv_path.exists():
         return mapping
     with csv_path.open("r", encoding="utf-8-sig", newline="") as f:
@@ -51,8 +59,16 @@ def load_keyword_to_tags(csv_path: Path = DICT_CSV_PATH) -> dict[str, list[dict]
             if len(tags) == 1 and tags[0] == {"key": "amenity", "value": "ramen"}:
                 tags = [{"key": "amenity", "value": "restaurant"}, {"key": "cuisine", "value": "ramen"}]
             if tags:
-                mapping[text] = tags
+                mapping[text] = interned.setdefault(tags_key(tags), tags)
     return mapping
 
+def dictionary_version(csv_path: Path = DICT_CSV_PATH) -> str:
+    """辞書 CSV の内容ハッシュ。キャッシュの無効化キーに使う。"""
+    if not csv_path.exists():
+        return "empty"
+    return hashlib.sha1(csv_path.read_bytes()).hexdigest()[:16]
+
+
 # 公開マップ
 KEYWORD_TO_TAGS: dict[str, list[dict]] = load_keyword_to_tags()
+DICT_VERSION: str = dictionary_version()
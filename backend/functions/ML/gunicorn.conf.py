@@ -0,0 +1,11 @@
+# gunicorn 設定: ワーカー数は runtime_config（tune_topology.py の出力 / 環境変数）から決める
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from runtime_config import DEFAULT_WORKERS, load_topology  # noqa: E402
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = load_topology().get("workers", DEFAULT_WORKERS)
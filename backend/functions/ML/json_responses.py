@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""事前シリアライズ済みレスポンスと高速 JSON レスポンス。
+
+辞書ヒット時のレスポンス本体 `{"searchTerms": [{"tags": [...]}]}` は
+タグ集合ごとに内容が固定なので、辞書の構築時に一度だけ bytes へエンコードしておき、
+ホットパスでは FastAPI の jsonable_encoder / 検証を通さずそのまま返します。
+
+エンコード形式は Starlette の `JSONResponse.render` と同一
+（ensure_ascii=False, separators=(",", ":"), UTF-8）なので、既存のレスポンスとバイト互換です。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi.responses import Response
+
+from dictionary import KEYWORD_TO_TAGS, tags_key
+from query_normalizer import BRAND_LEXICON
+
+# 辞書外のタグ集合（ブランド補助タグとのマージ結果など）を実行時に追加する上限
+_BODY_CACHE_MAX = int(os.environ.get("RESPONSE_BODY_CACHE_MAX", "4096"))
+
+
+class RawJSONResponse(Response):
+    """エンコード済み bytes をそのまま返す JSON レスポンス。"""
+
+    media_type = "application/json"
+
+
+def encode_json(content: Any) -> bytes:
+    """Starlette の JSONResponse と同じ形式で JSON を bytes にエンコードする。"""
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _search_terms_content(tags: List[Dict]) -> Dict[str, Any]:
+    return {"searchTerms": [{"tags": tags}]}
+
+
+def _build_body_table() -> Dict[Tuple[Tuple[str, str], ...], bytes]:
+    table: Dict[Tuple[Tuple[str, str], ...], bytes] = {}
+    tag_sets = list(KEYWORD_TO_TAGS.values())
+    # ブランドのみヒットした場合の既定タグも事前に用意する
+    for spec in BRAND_LEXICON.values():
+        tag_sets.append([{"key": t.get("key"), "value": t.get("value")} for t in spec.get("default_tags", [])])
+    for tags in tag_sets:
+        key = tags_key(tags)
+        if key and key not in table:
+            table[key] = encode_json(_search_terms_content(tags))
+    return table
+
+
+_BODY_TABLE: Dict[Tuple[Tuple[str, str], ...], bytes] = _build_body_table()
+_PREBUILT_COUNT = len(_BODY_TABLE)
+
+ANALYZE_ERROR_BODY = encode_json({"error": {"code": 400, "message": "解析不能なキーワードです。"}})
+
+
+def search_terms_body(hit: List[Dict]) -> Optional[bytes]:
+    """`match_query()` の結果に対応するエンコード済みレスポンス本体を返す。
+
+    `hit` が単一のタグ集合（`[{"tags": [...]}]`）でない場合は None を返すので、
+    呼び出し側で通常のエンコードにフォールバックしてください。
+    """
+    if len(hit) != 1 or set(hit[0]) != {"tags"}:
+        return None
+    tags = hit[0]["tags"]
+    key = tags_key(tags)
+    body = _BODY_TABLE.get(key)
+    if body is None:
+        body = encode_json(_search_terms_content(tags))
+        if len(_BODY_TABLE) - _PREBUILT_COUNT < _BODY_CACHE_MAX:
+            _BODY_TABLE[key] = body
+    return body
+
+
+def search_terms_response(hit: List[Dict]) -> RawJSONResponse:
+    body = search_terms_body(hit)
+    if body is None:
+        body = encode_json({"searchTerms": hit})
+    return RawJSONResponse(content=body)
+
+
+def prebuilt_body_count() -> int:
+    return _PREBUILT_COUNT
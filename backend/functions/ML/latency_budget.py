@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""リクエスト単位のレイテンシ予算と縮退（degraded）判定。
+
+予算を超えそうなときは NER / Transformer の段を飛ばし、辞書・ブランドだけの安い答えを
+`degraded` フラグ付きで返すための仕組みです。
+
+- 予算は `X-Latency-Budget-Ms` ヘッダー、なければ（読めなければ）環境変数 ANALYZE_LATENCY_BUDGET_MS（default=0: 無効）
+- 各段の所要時間は指数移動平均（EWMA）で見積もり、残り予算と比較する
+- Transformer は `InferenceQueue` で同時実行数を 1 に制限し、待ち行列の長さも見積もりに含める
+- 縮退の回数は理由別に数え、/api/v1/status で参照できる（ワーカー単位）
+
+計測対象モジュールはコンテキスト変数経由で現在の予算を参照します（stage_trace と同様）。
+NER の予算判定は辞書段だけに効きます。Transformer 段は実行を決めた時点で予算を外すので、
+その中の前処理で NER が省略されて縮退扱いになることはありません。
+
+環境変数:
+- ANALYZE_LATENCY_BUDGET_MS: 既定の予算ミリ秒（default=0: 無効）
+- LATENCY_EWMA_ALPHA: 見積もりの平滑化係数（default=0.2）
+- LATENCY_ESTIMATE_TTL_S: この秒数サンプルが無い見積もりは破棄して再計測する（default=30）。
+  縮退し続けて見積もりが更新されなくなるのを防ぐ
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+_EWMA_ALPHA = float(os.environ.get("LATENCY_EWMA_ALPHA", "0.2"))
+_ESTIMATE_TTL_S = float(os.environ.get("LATENCY_ESTIMATE_TTL_S", "30"))
+
+
+class StageCostEstimator:
+    """段ごとの所要時間の EWMA（ミリ秒）。サンプルが無い段は見積もり不能（None）。"""
+
+    def __init__(self, alpha: float = _EWMA_ALPHA, ttl_s: float = _ESTIMATE_TTL_S) -> None:
+        self.alpha = alpha
+        self.ttl_s = ttl_s
+        self._ewma: Dict[str, float] = {}
+        self._observed_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, ms: float) -> None:
+        with self._lock:
+            prev = self._ewma.get(stage)
+            self._ewma[stage] = ms if prev is None else prev + self.alpha * (ms - prev)
+            self._observed_at[stage] = time.monotonic()
+
+    def estimate(self, stage: str) -> Optional[float]:
+        observed_at = self._observed_at.get(stage)
+        if observed_at is None or time.monotonic() - observed_at > self.ttl_s:
+            return None
+        return self._ewma.get(stage)
+
+    def snapshot(self) -> Dict[str, float]:
+        return {k: round(v, 3) for k, v in self._ewma.items()}
+
+
+COSTS = StageCostEstimator()
+DEGRADED_COUNTS: Counter = Counter()
+_DEGRADED_RESPONSES = 0
+_COUNTS_LOCK = threading.Lock()
+
+
+class InferenceQueue:
+    """Transformer 推論の同時実行数を制限し、待ち件数を公開する。"""
+
+    def __init__(self, concurrency: int) -> None:
+        self.concurrency = max(1, concurrency)
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self.waiting = 0
+        self.active = 0
+
+    def estimated_wait_ms(self, stage: str = "transformer") -> Optional[float]:
+        cost = COSTS.estimate(stage)
+        if cost is None:
+            return None
+        ahead = self.waiting + (1 if self.active >= self.concurrency else 0)
+        return cost * ahead / self.concurrency
+
+    async def acquire(self, timeout_s: Optional[float] = None) -> bool:
+        """空き枠を待って確保する。`timeout_s` 以内に確保できなければ False。
+
+        空き枠があれば `timeout_s` に関わらず待たずに確保する（0 以下でも失敗にしない）。
+        """
+        if not self._sem.locked():
+            await self._sem.acquire()
+            self.active += 1
+            return True
+        if timeout_s is not None and timeout_s <= 0:
+            return False
+        self.waiting += 1
+        try:
+            if timeout_s is None:
+                await self._sem.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(self._sem.acquire(), timeout=timeout_s)
+                except asyncio.TimeoutError:
+                    return False
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+        self._sem.release()
+
+
+class LatencyBudget:
+    def __init__(self, budget_ms: float, start: Optional[float] = None) -> None:
+        self.budget_ms = budget_ms
+        self.start = time.perf_counter() if start is None else start
+        self.degraded: List[str] = []
+
+    def remaining_ms(self) -> float:
+        return self.budget_ms - (time.perf_counter() - self.start) * 1000.0
+
+    def can_afford(self, stage: str, extra_wait_ms: float = 0.0) -> bool:
+        cost = COSTS.estimate(stage)
+        if cost is None:
+            # 見積もりが無いうちは実行して計測する
+            return self.remaining_ms() > extra_wait_ms
+        return self.remaining_ms() >= cost + extra_wait_ms
+
+    def mark_degraded(self, reason: str) -> None:
+        if reason not in self.degraded:
+            self.degraded.append(reason)
+            with _COUNTS_LOCK:
+                DEGRADED_COUNTS[reason] += 1
+
+
+_CURRENT: contextvars.ContextVar[Optional[LatencyBudget]] = contextvars.ContextVar("latency_budget", default=None)
+
+
+def _parse_ms(raw: Optional[str]) -> Optional[float]:
+    try:
+        ms = float(raw)
+    except (TypeError, ValueError):
+        return None
+    return ms if math.isfinite(ms) else None
+
+
+def parse_budget_ms(value: Optional[str]) -> Optional[float]:
+    """ヘッダー値から予算ミリ秒を得る。0 以下は予算なし。
+
+    ヘッダーが無い・数値として読めない場合は環境変数の既定値を使う
+    （不正なヘッダーで既定の予算が外れないようにする）。
+    """
+    ms = _parse_ms(value) if value else None
+    if ms is None:
+        ms = _parse_ms(os.environ.get("ANALYZE_LATENCY_BUDGET_MS", "0"))
+    return ms if ms is not None and ms > 0 else None
+
+
+@contextlib.contextmanager
+def budget_scope(budget: Optional[LatencyBudget]):
+    token = _CURRENT.set(budget)
+    try:
+        yield budget
+    finally:
+        _CURRENT.reset(token)
+
+
+def current_budget() -> Optional[LatencyBudget]:
+    return _CURRENT.get()
+
+
+def allow_stage(stage: str, reason: str) -> bool:
+    """予算内で `stage` を実行できるか。できなければ縮退として記録して False。"""
+    budget = _CURRENT.get()
+    if budget is None or budget.can_afford(stage):
+        return True
+    budget.mark_degraded(reason)
+    return False
+
+
+def count_degraded_response() -> None:
+    global _DEGRADED_RESPONSES
+    with _COUNTS_LOCK:
+        _DEGRADED_RESPONSES += 1
+
+
+def degraded_stats() -> Dict[str, object]:
+    with _COUNTS_LOCK:
+        responses, reasons = _DEGRADED_RESPONSES, dict(DEGRADED_COUNTS)
+    return {"responses": responses, "reasons": reasons, "stage_cost_ms": COSTS.snapshot()}
+
+
+@contextlib.contextmanager
+def measure_stage(stage: str):
+    """`stage` の所要時間を見積もりに反映する。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        COSTS.observe(stage, (time.perf_counter() - start) * 1000.0)
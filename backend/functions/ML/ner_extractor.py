@@ -10,24 +10,26 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Callable, Dict, List, Optional, Tuple
 import os
+import threading
+
+from latency_budget import allow_stage, measure_stage
+from request_log import get_logger
+
+logger = get_logger("ner")
 
 
 _NER_PIPELINE = None
 _NER_LOAD_FAILED = False
 _NER_SOURCE = "lexicon"
+# パイプライン（fast tokenizer）はスレッドセーフでないので、辞書段（イベントループ）と
+# Transformer 段（スレッドプール）からの呼び出しを直列化する
+_NER_LOCK = threading.Lock()
 
 
-def _load_ner_pipeline():
-    global _NER_PIPELINE, _NER_LOAD_FAILED, _NER_SOURCE
-
-    if _NER_PIPELINE is not None:
-        return _NER_PIPELINE
-    if _NER_LOAD_FAILED:
-        return None
-
+def _ner_model_dir() -> Optional[str]:
+    """使用する NER モデルのディレクトリ。無効化されているか見つからなければ None。"""
     enable = os.environ.get("NER_ENABLE_TRANSFORMER", "1").lower()
     if enable in ("0", "false", "off", "no"):
-        _NER_LOAD_FAILED = True
         return None
 
     # 優先順位: 明示指定 -> ローカル既定
@@ -36,7 +38,30 @@ def _load_ner_pipeline():
         local_default = Path(__file__).with_name("ner_model")
         if local_default.exists():
             model_dir = str(local_default)
+    return model_dir or None
+
 
+def ner_model_version() -> str:
+    """NER の出力を左右する設定（モデルの場所・ファイル更新時刻・NER_MIN_CONF）から版を作る。"""
+    model_dir = _ner_model_dir()
+    mtimes = []
+    if model_dir and os.path.isdir(model_dir):
+        for name in sorted(os.listdir(model_dir)):
+            path = os.path.join(model_dir, name)
+            if os.path.isfile(path):
+                mtimes.append(f"{name}:{os.path.getmtime(path):.0f}")
+    return f"{model_dir or 'lexicon'}|{','.join(mtimes)}|{os.environ.get('NER_MIN_CONF', '')}"
+
+
+def _load_ner_pipeline():
+    global _NER_PIPELINE, _NER_LOAD_FAILED, _NER_SOURCE
+
+    if _NER_PIPELINE is not None:
+        return _NER_PIPELINE
+    if _NER_LOAD_FAILED:
+        return None
+
+    model_dir = _ner_model_dir()
     if not model_dir:
         _NER_LOAD_FAILED = True
         return None
@@ -57,7 +82,7 @@ def _load_ner_pipeline():
         _NER_SOURCE = f"transformer:{model_dir}"
         return _NER_PIPELINE
     except Exception as e:
-        print("[NER] transformer load failed:", e)
+        logger.error("NER transformer load failed", extra={"fields": {"model_dir": model_dir, "error": str(e)}})
         _NER_LOAD_FAILED = True
         return None
 
@@ -93,10 +118,15 @@ def _extract_by_transformer(query: str) -> List[Tuple[str, str, float]]:
     if ner_pipe is None:
         return []
 
+    # レイテンシ予算が足りなければ辞書ベースのみで済ませる（予算は辞書段でのみ有効）
+    if not allow_stage("ner", "ner_skipped"):
+        return []
+
     try:
-        raw = ner_pipe(query)
+        with _NER_LOCK, measure_stage("ner"):
+            raw = ner_pipe(query)
     except Exception as e:
-        print("[NER] inference failed:", e)
+        logger.warning("NER inference failed", extra={"fields": {"error": str(e)}})
         return []
 
     out: List[Tuple[str, str, float]] = []
@@ -15,6 +15,7 @@ import re
 import unicodedata
 from typing import Dict, List, Optional
 from ner_extractor import extract_brands_and_categories
+from stage_trace import stage
 
 # 近傍検索で頻出の機能語
 _SEARCH_NOISE = [
@@ -109,12 +110,14 @@ def _remove_brand_aliases(normalized_query: str, brands: List[str]) -> str:
 
 
 def extract_query_entities(query: str) -> QueryEntities:
-    nq = normalize_text(query)
-    brands, categories, ner_source = extract_brands_and_categories(
-        query=query,
-        brand_lexicon=BRAND_LEXICON,
-        normalize_fn=normalize_text,
-    )
+    with stage("normalize"):
+        nq = normalize_text(query)
+    with stage("ner"):
+        brands, categories, ner_source = extract_brands_and_categories(
+            query=query,
+            brand_lexicon=BRAND_LEXICON,
+            normalize_fn=normalize_text,
+        )
     category_query = _remove_brand_aliases(nq, brands)
     if not category_query and categories:
         category_query = categories[0]
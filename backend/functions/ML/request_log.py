@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""非ブロッキングな構造化ロガー（リクエストログ用）。
+
+- ログレコードは QueueHandler でキューに積むだけで、stdout への書き込みは
+  QueueListener のバックグラウンドスレッドが行う（イベントループをブロックしない）
+- 1 レコード = 1 行の JSON（Cloud Logging がそのまま構造化ログとして取り込める形式）
+- 成功リクエストはサンプリング、失敗・低速リクエストは常に記録
+
+環境変数:
+- REQUEST_LOG_SAMPLE_RATE: 成功リクエストを記録する割合（default=0.01）
+- REQUEST_LOG_SLOW_MS: これを超えたリクエストは成功でも常に記録（default=500）
+- REQUEST_LOG_QUEUE_MAX: 出力待ちレコードの上限（default=10000）。溢れたレコードは
+  待たずに破棄して数える（`dropped_log_records()`、/api/v1/status で参照できる）
+- LOG_LEVEL: ロガーのレベル（default=INFO）
+"""
+
+from __future__ import annotations
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+_QUERY_LOG_MAX_CHARS = 200
+
+# stdout が詰まってもメモリを使い切らないよう上限を設ける
+_LOG_QUEUE: "queue.Queue[logging.LogRecord]" = queue.Queue(
+    maxsize=int(os.environ.get("REQUEST_LOG_QUEUE_MAX", "10000"))
+)
+_LISTENER: Optional[logging.handlers.QueueListener] = None
+_DROPPED = 0
+_DROPPED_LOCK = threading.Lock()
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _StructuredQueueHandler(logging.handlers.QueueHandler):
+    """メッセージとトレースバックを分けたままキューに積む QueueHandler。
+
+    既定の `prepare()` は整形済みメッセージにトレースバックを連結して `exc_info` を捨てるので、
+    ここではメッセージ引数だけ展開し、トレースバックは `exc_text` に文字列で渡す。
+    """
+
+    _traceback_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # キューが満杯でも呼び出し元（イベントループ）を待たせず、破棄して数える
+        global _DROPPED
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _DROPPED_LOCK:
+                _DROPPED += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # 終了時はキューが満杯でも、リスナーが取り出すのを待って終了通知を積む
+        self.queue.put(self._sentinel)
+
+
+def dropped_log_records() -> int:
+    """キューが満杯で破棄したログレコードの件数（ワーカー単位）。"""
+    with _DROPPED_LOCK:
+        return _DROPPED
+
+
+def _start_listener() -> None:
+    global _LISTENER
+    if _LISTENER is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(_JsonFormatter())
+    _LISTENER = _QueueListener(_LOG_QUEUE, stream, respect_handler_level=False)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """キュー経由で JSON 行を出力するロガーを返す。"""
+    _start_listener()
+    logger = logging.getLogger(f"osmtag.{name}")
+    if not any(isinstance(h, logging.handlers.QueueHandler) for h in logger.handlers):
+        logger.addHandler(_StructuredQueueHandler(_LOG_QUEUE))
+        logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        logger.propagate = False
+    return logger
+
+
+def new_request_id(incoming: Optional[str] = None) -> str:
+    """呼び出し元から渡された ID があればそれを使い、なければ新しく採番する。"""
+    rid = (incoming or "").strip()
+    return rid[:64] if rid else uuid.uuid4().hex
+
+
+def _should_log(status_code: int, latency_ms: float) -> bool:
+    if status_code >= 400:
+        return True
+    if latency_ms >= float(os.environ.get("REQUEST_LOG_SLOW_MS", "500")):
+        return True
+    rate = float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", "0.01"))
+    return rate > 0 and random.random() < rate
+
+
+_REQUEST_LOGGER = get_logger("request")
+
+
+def log_request(
+    request_id: str,
+    query: Optional[str],
+    status_code: int,
+    latency_ms: float,
+    **fields: Any,
+) -> None:
+    """1 リクエスト分のサマリを記録する（サンプリング判定込み）。"""
+    if not _should_log(status_code, latency_ms):
+        return
+    entry: Dict[str, Any] = {
+        "request_id": request_id,
+        "query": (query or "")[:_QUERY_LOG_MAX_CHARS],
+        "status": status_code,
+        "latency_ms": round(latency_ms, 2),
+    }
+    entry.update(fields)
+    level = logging.WARNING if status_code >= 400 else logging.INFO
+    _REQUEST_LOGGER.log(level, "analyze-keywords", extra={"fields": entry})
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""実行トポロジ（gunicorn ワーカー数 × torch スレッド数）の設定。
+
+`tune_topology.py` が書き出す JSON を起動時に読み込みます。torch には依存しないので
+gunicorn.conf.py からも import できます。
+
+優先順位: 環境変数 > 設定ファイル > 既定値（torch の既定 / ワーカー 4）
+
+環境変数:
+- RUNTIME_TOPOLOGY_PATH: 設定ファイルのパス（default=ML/runtime_topology.json）
+- GUNICORN_WORKERS: ワーカー数
+- TORCH_NUM_THREADS: 1 ワーカーあたりの intra-op スレッド数
+- TORCH_NUM_INTEROP_THREADS: 1 ワーカーあたりの inter-op スレッド数
+
+設定ファイル形式:
+  {"workers": 2, "intra_op_threads": 2, "inter_op_threads": 1}
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+DEFAULT_TOPOLOGY_PATH = Path(__file__).with_name("runtime_topology.json")
+DEFAULT_WORKERS = 4
+
+_ENV_KEYS = {
+    "workers": "GUNICORN_WORKERS",
+    "intra_op_threads": "TORCH_NUM_THREADS",
+    "inter_op_threads": "TORCH_NUM_INTEROP_THREADS",
+}
+
+
+def topology_path() -> Path:
+    return Path(os.environ.get("RUNTIME_TOPOLOGY_PATH") or DEFAULT_TOPOLOGY_PATH)
+
+
+def load_topology(path: Optional[Path] = None) -> Dict[str, Any]:
+    """設定ファイルと環境変数を合成したトポロジ設定を返す。未設定の項目は含まない。"""
+    path = path or topology_path()
+    topo: Dict[str, Any] = {}
+    if path.exists():
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                topo.update(data)
+        except (OSError, ValueError):
+            pass
+    for key, env in _ENV_KEYS.items():
+        value = os.environ.get(env)
+        if value:
+            topo[key] = value
+    out: Dict[str, Any] = {}
+    for key in ("workers", "intra_op_threads", "inter_op_threads"):
+        try:
+            value = int(topo[key])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if value > 0:
+            out[key] = value
+    return out
+
+
+def save_topology(topo: Dict[str, Any], path: Optional[Path] = None) -> Path:
+    path = path or topology_path()
+    with path.open("w", encoding="utf-8") as f:
+        json.dump(topo, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    return path
+
+
+def apply_torch_threads(torch_module, topo: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """トポロジ設定の intra-op / inter-op スレッド数を torch に反映する。"""
+    topo = load_topology() if topo is None else topo
+    intra = topo.get("intra_op_threads")
+    inter = topo.get("inter_op_threads")
+    if intra:
+        torch_module.set_num_threads(int(intra))
+    if inter:
+        try:
+            torch_module.set_num_interop_threads(int(inter))
+        except RuntimeError:
+            # inter-op の並列処理が一度でも始まった後は変更できない
+            pass
+    return topo
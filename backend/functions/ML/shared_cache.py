@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""ワーカー間で共有する analyze() 結果キャッシュ（任意）。
+
+gunicorn の各ワーカーが同じクエリを個別に推論しないよう、Transformer 経路の結果
+（ステータスコード + エンコード済みレスポンス本体）をプロセス外に保存します。
+
+バックエンド（環境変数 SHARED_CACHE_URL で選択。未設定なら無効）:
+- `sqlite:///dev/shm/osmtag_cache.db`: 同一ホストのワーカー間で共有するローカルファイル（/dev/shm 推奨）
+- `redis://host:6379/0`: Redis 互換サーバ（`redis` パッケージが必要）
+- `memory://`: プロセス内の辞書（テストやローカル確認用の代替実装）
+
+キーにはモデルと辞書のバージョンを含めるので、モデル再読み込みや辞書更新で自動的に無効化されます。
+
+環境変数:
+- SHARED_CACHE_MAX_ENTRIES: 最大件数（default=10000。sqlite/memory で使用。Redis は maxmemory で制限）
+- SHARED_CACHE_TTL_S: 有効期限秒（default=86400）
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from request_log import get_logger
+
+logger = get_logger("shared_cache")
+
+_KEY_PREFIX = "osmtag:analyze:"
+
+
+class MemoryBackend:
+    """プロセス内 LRU。共有はされないが、他バックエンドの代替として同じ振る舞いをする。"""
+
+    def __init__(self, max_entries: int, ttl_s: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._data: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl_s, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class SqliteBackend:
+    """ローカルファイル（/dev/shm など）上の SQLite を共有ストアとして使う。
+
+    参照時刻を粗く更新する近似 LRU で、件数が上限を超えたら古いものから削除します。
+    """
+
+    _TOUCH_INTERVAL_S = 60.0
+    _EVICT_EVERY = 64
+    # リクエスト中の get/set は待たずにミス扱いにする
+    _REQUEST_TIMEOUT_S = 0.05
+    # 起動時のスキーマ作成は全ワーカーが同時に行うので、ロック待ちを長めに取って再試行する
+    _SETUP_TIMEOUT_S = 5.0
+    _SETUP_ATTEMPTS = 3
+
+    def __init__(self, path: str, max_entries: int, ttl_s: float) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._local = threading.local()
+        self._writes = 0
+        self._setup()
+
+    def _setup(self) -> None:
+        for attempt in range(self._SETUP_ATTEMPTS):
+            try:
+                conn = sqlite3.connect(self.path, timeout=self._SETUP_TIMEOUT_S, isolation_level=None)
+                try:
+                    # WAL はデータベースファイルに記録されるので、ここで一度設定すればよい
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS cache ("
+                        "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                    )
+                    conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+                finally:
+                    conn.close()
+                return
+            except sqlite3.OperationalError:
+                if attempt + 1 >= self._SETUP_ATTEMPTS:
+                    raise
+                time.sleep(0.1 * (attempt + 1))
+
+    def _conn(self) -> sqlite3.Connection:
+        # 接続はスレッド（および fork 後のプロセス）ごとに作る
+        conn = getattr(self._local, "conn", None)
+        pid = getattr(self._local, "pid", None)
+        if conn is None or pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self._REQUEST_TIMEOUT_S, isolation_level=None)
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires_at, accessed_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at, accessed_at = row
+        now = time.time()
+        if expires_at < now:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        if now - accessed_at > self._TOUCH_INTERVAL_S:
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return bytes(value)
+
+    def set(self, key: str, value: bytes) -> None:
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, value, now + self.ttl_s, now),
+        )
+        self._writes += 1
+        if self._writes % self._EVICT_EVERY == 0:
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                (excess,),
+            )
+
+
+class RedisBackend:
+    """Redis 互換サーバ。件数の上限はサーバ側の maxmemory / eviction ポリシーに任せる。"""
+
+    def __init__(self, url: str, ttl_s: float) -> None:
+        import redis  # optional dependency
+
+        self.ttl_s = ttl_s
+        self._client = redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.2)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(key)
+
+    def set(self, key: str, value: bytes) -> None:
+        self._client.set(key, value, ex=max(1, int(self.ttl_s)))
+
+
+def _create_backend(url: str, max_entries: int, ttl_s: float):
+    if url.startswith("memory://"):
+        return MemoryBackend(max_entries, ttl_s)
+    if url.startswith("sqlite://"):
+        return SqliteBackend(url[len("sqlite://"):], max_entries, ttl_s)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url, ttl_s)
+    raise ValueError(f"unsupported SHARED_CACHE_URL: {url}")
+
+
+class SharedResultCache:
+    """(モデル版, 辞書版, クエリ) → (status_code, body) のキャッシュ。
+
+    バックエンドの障害はリクエストを失敗させず、キャッシュミスとして扱います。
+    """
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self.namespace = ""
+
+    def set_versions(self, model_version: str, dict_version: str) -> None:
+        """モデル/辞書のバージョンを設定する。変わると以前のエントリは参照されなくなる。"""
+        self.namespace = hashlib.sha1(f"{model_version}|{dict_version}".encode("utf-8")).hexdigest()[:16]
+
+    def _key(self, query: str) -> str:
+        digest = hashlib.sha1(query.encode("utf-8")).hexdigest()
+        return f"{_KEY_PREFIX}{self.namespace}:{digest}"
+
+    def get(self, query: str) -> Optional[Tuple[int, bytes]]:
+        try:
+            value = self.backend.get(self._key(query))
+        except Exception as e:
+            logger.warning("shared cache get failed", extra={"fields": {"error": str(e)}})
+            return None
+        if not value or len(value) < 3:
+            return None
+        return int(value[:3]), value[3:]
+
+    def set(self, query: str, status_code: int, body: bytes) -> None:
+        try:
+            self.backend.set(self._key(query), b"%03d" % status_code + body)
+        except Exception as e:
+            logger.warning("shared cache set failed", extra={"fields": {"error": str(e)}})
+
+
+def create_shared_cache() -> Optional[SharedResultCache]:
+    """環境変数からキャッシュを作る。未設定・初期化失敗時は None（キャッシュなしで動作）。"""
+    url = os.environ.get("SHARED_CACHE_URL")
+    if not url:
+        return None
+    max_entries = int(os.environ.get("SHARED_CACHE_MAX_ENTRIES", "10000"))
+    ttl_s = float(os.environ.get("SHARED_CACHE_TTL_S", "86400"))
+    try:
+        return SharedResultCache(_create_backend(url, max_entries, ttl_s))
+    except Exception as e:
+        logger.error("shared cache init failed", extra={"fields": {"url": url, "error": str(e)}})
+        return None
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""リクエスト単位のステージ計測（デバッグ用・オプトイン）。
+
+`/api/v1/analyze-keywords` に `X-Debug-Trace` ヘッダー（または `?trace=` クエリ）を付けると、
+正規化 / NER / 辞書照合 / トークナイズ / 推論 / ラベル解決 の各ステージの所要時間を返します。
+`profile` を指定した場合は cProfile の結果（累積時間上位）も添付します。
+
+cProfile はスレッド単位なので、プロファイルは Transformer 段を実行するスレッドプール内
+（`profiled()` の範囲）だけで取ります。イベントループ上の他リクエストは混ざりません。
+辞書ヒットなど Transformer 段に到達しないリクエストではプロファイルは付きません。
+プロファイルはワーカーあたり同時に 1 リクエストまでで、実行中なら通常のトレースに切り替えます。
+
+環境変数:
+- ANALYZE_TRACE_ENABLE: 1 のときだけ有効（default=0）。無効時は `stage()` / `note()` は何もしない。
+- ANALYZE_TRACE_PROFILE_TOP: cProfile 出力の行数（default=25）
+
+計測対象モジュールはコンテキスト変数経由で現在のトレースを参照するので、
+関数の引数を増やす必要はありません。
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+TRACE_ENABLED = os.environ.get("ANALYZE_TRACE_ENABLE", "0").lower() in ("1", "true", "on", "yes")
+
+_CURRENT: contextvars.ContextVar[Optional["StageTrace"]] = contextvars.ContextVar("stage_trace", default=None)
+_NULL_CONTEXT = contextlib.nullcontext()
+_PROFILE_LOCK = threading.Lock()
+
+
+class StageTrace:
+    def __init__(self) -> None:
+        self._t0 = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.profile: Optional[str] = None
+        self.profiling = False
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **data: Any) -> Iterator[Dict[str, Any]]:
+        start = time.perf_counter()
+        event: Dict[str, Any] = {"stage": name, "start_ms": round((start - self._t0) * 1000.0, 3)}
+        event.update(data)
+        self.events.append(event)
+        try:
+            yield event
+        finally:
+            event["ms"] = round((time.perf_counter() - start) * 1000.0, 3)
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "total_ms": round((time.perf_counter() - self._t0) * 1000.0, 3),
+            "stages": self.events,
+        }
+        if self.profile is not None:
+            out["profile"] = self.profile
+        return out
+
+
+def parse_trace_flag(value: Optional[str]) -> Optional[str]:
+    """ヘッダー/クエリの値を "trace" / "profile" / None に解釈する。無効時は常に None。"""
+    if not TRACE_ENABLED or not value:
+        return None
+    v = value.strip().lower()
+    if v == "profile":
+        return "profile"
+    if v in ("1", "true", "on", "yes", "trace"):
+        return "trace"
+    return None
+
+
+@contextlib.contextmanager
+def tracing(profile: bool = False) -> Iterator[StageTrace]:
+    """このコンテキスト内の `stage()` / `note()` を記録する。"""
+    trace = StageTrace()
+    if profile:
+        if _PROFILE_LOCK.acquire(blocking=False):
+            trace.profiling = True
+        else:
+            trace.events.append({"note": "profile_busy"})
+    token = _CURRENT.set(trace)
+    try:
+        yield trace
+    finally:
+        _CURRENT.reset(token)
+        if trace.profiling:
+            _PROFILE_LOCK.release()
+
+
+@contextlib.contextmanager
+def profiled() -> Iterator[None]:
+    """プロファイル要求中なら、このスレッドでの処理を cProfile で計測してトレースに添付する。"""
+    trace = _CURRENT.get() if TRACE_ENABLED else None
+    if trace is None or not trace.profiling:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        buf = io.StringIO()
+        top = int(os.environ.get("ANALYZE_TRACE_PROFILE_TOP", "25"))
+        pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(top)
+        trace.profile = buf.getvalue()
+
+
+def stage(name: str, **data: Any):
+    """計測中ならステージを記録するコンテキストマネージャを返す。それ以外は何もしない。"""
+    if not TRACE_ENABLED:
+        return _NULL_CONTEXT
+    trace = _CURRENT.get()
+    if trace is None:
+        return _NULL_CONTEXT
+    return trace.stage(name, **data)
+
+
+def note(name: str, **data: Any) -> None:
+    """所要時間を伴わない情報（試行した辞書候補など）を記録する。"""
+    if not TRACE_ENABLED:
+        return
+    trace = _CURRENT.get()
+    if trace is None:
+        return
+    event: Dict[str, Any] = {"note": name}
+    event.update(data)
+    trace.events.append(event)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""ワーカー数 × torch スレッド数 × バッチサイズのグリッドを手元マシンで計測し、推奨構成を選ぶ。
+
+各構成について gunicorn ワーカーを模した N 個のプロセスを起動し、
+それぞれが `api._predict_labels_batch`（batch_size=1 のときは `api._predict_labels`）を
+一定時間回し続けます。目標 p99 を満たす構成のうちスループット最大のものを推奨し、
+`--write` を付けると runtime_config の設定ファイルに保存します（api.py / gunicorn.conf.py が起動時に読む）。
+
+サービスは 1 リクエストずつ推論するので、推奨は batch_size=1 の構成からだけ選びます。
+batch_size>1 の結果はバッチ推論を導入する際の参考値として別に表示し、設定には保存しません。
+
+使い方:
+  python tune_topology.py --target-p99-ms 150 --duration 10 --write
+  python tune_topology.py --workers 1,2,4 --threads 1,2,4 --batch-sizes 1,4 --queries queries.txt
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import time
+from typing import Dict, List, Optional, Tuple
+
+from runtime_config import save_topology, topology_path
+
+
+def _parse_int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def _load_queries(path: Optional[str]) -> List[str]:
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        from dictionary import KEYWORD_TO_TAGS
+
+        queries = list(KEYWORD_TO_TAGS.keys())
+    if not queries:
+        raise ValueError("計測用のクエリが 1 件もありません。")
+    return queries
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    idx = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def _worker(
+    worker_id: int,
+    intra: int,
+    inter: int,
+    batch_size: int,
+    queries: List[str],
+    duration: float,
+    warmup: int,
+    ready_q,
+    start_event,
+    result_q,
+) -> None:
+    os.environ["TORCH_NUM_THREADS"] = str(intra)
+    os.environ["TORCH_NUM_INTEROP_THREADS"] = str(inter)
+    # api の import 時に上記スレッド数が torch に反映される
+    import api
+
+    if api._load_transformer()[0] is None:
+        ready_q.put((worker_id, False))
+        return
+
+    def run_batch(batch: List[str]) -> None:
+        if batch_size == 1:
+            api._predict_labels(batch[0], top_k=2)
+        else:
+            api._predict_labels_batch(batch, top_k=2)
+
+    cycle = itertools.cycle(queries[worker_id:] + queries[:worker_id])
+    for _ in range(warmup):
+        run_batch([next(cycle) for _ in range(batch_size)])
+
+    ready_q.put((worker_id, True))
+    start_event.wait()
+    latencies: List[float] = []
+    processed = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        batch = [next(cycle) for _ in range(batch_size)]
+        t0 = time.perf_counter()
+        run_batch(batch)
+        elapsed_ms = (time.perf_counter() - t0) * 1000.0
+        # バッチ内の各リクエストはバッチ全体の完了を待つ
+        latencies.extend([elapsed_ms] * len(batch))
+        processed += len(batch)
+    result_q.put((worker_id, latencies, processed))
+
+
+def _collect(q, procs, count: int, timeout_s: float) -> Optional[List[Tuple]]:
+    """`count` 件の報告を集める。ワーカーが異常終了したりタイムアウトしたら None。"""
+    items: List[Tuple] = []
+    deadline = time.monotonic() + timeout_s
+    while len(items) < count:
+        if time.monotonic() > deadline:
+            return None
+        try:
+            items.append(q.get(timeout=0.5))
+        except queue.Empty:
+            # 正常終了したワーカーの報告はキューに残っているので、異常終了だけを失敗とみなす
+            if any(p.exitcode not in (None, 0) for p in procs):
+                return None
+            if len(items) < count and all(p.exitcode is not None for p in procs) and q.empty():
+                return None
+    return items
+
+
+def measure(
+    workers: int,
+    intra: int,
+    inter: int,
+    batch_size: int,
+    queries: List[str],
+    duration: float,
+    warmup: int,
+    startup_timeout: float = 600.0,
+) -> Optional[Dict]:
+    """1 構成を計測する。ワーカーの起動失敗・異常終了・タイムアウト時は None。"""
+    ctx = mp.get_context("spawn")
+    ready_q = ctx.Queue()
+    result_q = ctx.Queue()
+    start_event = ctx.Event()
+    procs = [
+        ctx.Process(
+            target=_worker,
+            args=(i, intra, inter, batch_size, queries, duration, warmup, ready_q, start_event, result_q),
+        )
+        for i in range(workers)
+    ]
+    for p in procs:
+        p.start()
+
+    try:
+        ready = _collect(ready_q, procs, workers, startup_timeout)
+        if ready is None or not all(ok for _, ok in ready):
+            return None
+
+        start_event.set()
+        t0 = time.perf_counter()
+        # 計測時間に加えて、最後の 1 バッチの完了を待つ余裕を持たせる
+        reports = _collect(result_q, procs, workers, duration + max(30.0, duration))
+        wall = time.perf_counter() - t0
+        if reports is None:
+            return None
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join(timeout=5)
+
+    latencies: List[float] = []
+    processed = 0
+    for _, lat, n in reports:
+        latencies.extend(lat)
+        processed += n
+    if not latencies:
+        return None
+    latencies.sort()
+    return {
+        "workers": workers,
+        "intra_op_threads": intra,
+        "inter_op_threads": inter,
+        "batch_size": batch_size,
+        "throughput_qps": processed / wall if wall > 0 else 0.0,
+        "p50_ms": _percentile(latencies, 50),
+        "p99_ms": _percentile(latencies, 99),
+    }
+
+
+def recommend(results: List[Dict], target_p99_ms: float) -> Optional[Dict]:
+    """batch_size=1 の構成のうち、目標 p99 以内で最大スループットのもの。
+
+    満たすものがなければ p99 最小の構成。サービスはバッチ推論しないので batch_size>1 は対象外。
+    """
+    unbatched = [r for r in results if r["batch_size"] == 1]
+    if not unbatched:
+        return None
+    ok = [r for r in unbatched if r["p99_ms"] <= target_p99_ms]
+    if ok:
+        return max(ok, key=lambda r: r["throughput_qps"])
+    return min(unbatched, key=lambda r: r["p99_ms"])
+
+
+def main() -> None:
+    cpu = os.cpu_count() or 1
+    default_workers = ",".join(str(w) for w in (1, 2, 4, 8) if w <= cpu) or "1"
+    default_threads = ",".join(str(t) for t in (1, 2, 4, 8) if t <= cpu) or "1"
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", default=default_workers, help="ワーカー数の候補（カンマ区切り）")
+    ap.add_argument("--threads", default=default_threads, help="intra-op スレッド数の候補（カンマ区切り）")
+    ap.add_argument("--interop-threads", default="1", help="inter-op スレッド数の候補（カンマ区切り）")
+    ap.add_argument(
+        "--batch-sizes",
+        default="1",
+        help="バッチサイズの候補（カンマ区切り）。1 以外は参考値として表示のみ",
+    )
+    ap.add_argument("--target-p99-ms", type=float, default=200.0)
+    ap.add_argument("--duration", type=float, default=10.0, help="1 構成あたりの計測秒数")
+    ap.add_argument("--warmup", type=int, default=5, help="計測前のウォームアップ回数")
+    ap.add_argument(
+        "--startup-timeout",
+        type=float,
+        default=600.0,
+        help="ワーカーのモデル読み込み・ウォームアップを待つ秒数",
+    )
+    ap.add_argument("--queries", default=None, help="計測用クエリ（1 行 1 件）。省略時は辞書のキーワード")
+    ap.add_argument(
+        "--allow-oversubscribe",
+        action="store_true",
+        help="workers × threads が CPU コア数を超える構成も計測する",
+    )
+    ap.add_argument("--write", action="store_true", help=f"推奨構成を {topology_path()} に保存する")
+    args = ap.parse_args()
+
+    queries = _load_queries(args.queries)
+    grid = itertools.product(
+        _parse_int_list(args.workers),
+        _parse_int_list(args.threads),
+        _parse_int_list(args.interop_threads),
+        _parse_int_list(args.batch_sizes),
+    )
+
+    results: List[Dict] = []
+    for workers, intra, inter, batch_size in grid:
+        if not args.allow_oversubscribe and workers * intra > cpu:
+            continue
+        r = measure(workers, intra, inter, batch_size, queries, args.duration, args.warmup, args.startup_timeout)
+        if r is None:
+            print(
+                f"workers={workers} threads={intra}/{inter} batch={batch_size}: "
+                "計測に失敗しました（モデル読み込み失敗・ワーカー異常終了・タイムアウト）"
+            )
+            continue
+        results.append(r)
+        print(
+            f"workers={workers} threads={intra}/{inter} batch={batch_size}: "
+            f"{r['throughput_qps']:.1f} qps, p50={r['p50_ms']:.1f}ms, p99={r['p99_ms']:.1f}ms"
+        )
+
+    batched = [r for r in results if r["batch_size"] != 1]
+    if batched:
+        best_batched = max(batched, key=lambda r: r["throughput_qps"])
+        print(
+            "参考（バッチ推論、サービスでは未使用のため保存しません）: "
+            f"workers={best_batched['workers']} threads={best_batched['intra_op_threads']}/"
+            f"{best_batched['inter_op_threads']} batch={best_batched['batch_size']}: "
+            f"{best_batched['throughput_qps']:.1f} qps, p99={best_batched['p99_ms']:.1f}ms"
+        )
+
+    best = recommend(results, args.target_p99_ms)
+    if best is None:
+        print("batch_size=1 の計測結果がありません（--batch-sizes に 1 を含めてください）。")
+        return
+    if best["p99_ms"] > args.target_p99_ms:
+        print(f"目標 p99 {args.target_p99_ms}ms を満たす構成はありません。p99 最小の構成を推奨します。")
+    topo = {k: best[k] for k in ("workers", "intra_op_threads", "inter_op_threads")}
+    print(f"推奨: {topo} ({best['throughput_qps']:.1f} qps, p99={best['p99_ms']:.1f}ms)")
+    if args.write:
+        path = save_topology(topo)
+        print(f"保存しました: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# ML/ のモジュールは同一ディレクトリからの絶対 import（`from dictionary import ...`）を前提にしている
+ML_DIR = Path(__file__).resolve().parent.parent / "ML"
+if str(ML_DIR) not in sys.path:
+    sys.path.insert(0, str(ML_DIR))
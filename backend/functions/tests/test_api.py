@@ -0,0 +1,218 @@
+"""analyze() の経路（辞書 / 共有キャッシュ / Transformer）と縮退応答を確認する。
+
+モデルは読み込まず、`_load_transformer` / `_predict_labels` を差し替えて動かす。
+"""
+
+import asyncio
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import api  # noqa: E402
+import latency_budget  # noqa: E402
+import ner_extractor  # noqa: E402
+from latency_budget import InferenceQueue, StageCostEstimator  # noqa: E402
+from shared_cache import MemoryBackend, SharedResultCache  # noqa: E402
+
+MISS_QUERY = "zzzzqqqq"
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(latency_budget, "COSTS", StageCostEstimator())
+    monkeypatch.setattr(api, "COSTS", latency_budget.COSTS)
+    # asyncio.Semaphore はイベントループに紐づくので、テストごとに作り直す
+    monkeypatch.setattr(api, "_TR_QUEUE", InferenceQueue(1))
+    monkeypatch.setattr(api, "_SHARED_CACHE", None)
+    monkeypatch.setattr(api, "_TR_VERSION", None)
+
+
+@pytest.fixture
+def shared_cache(monkeypatch):
+    cache = SharedResultCache(MemoryBackend(100, 60.0))
+    monkeypatch.setattr(api, "_SHARED_CACHE", cache)
+    return cache
+
+
+class _FakeNerPipeline:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __call__(self, query):
+        self.calls += 1
+        return []
+
+
+@pytest.fixture
+def ner_pipe(monkeypatch):
+    pipe = _FakeNerPipeline()
+    monkeypatch.setattr(ner_extractor, "_NER_PIPELINE", pipe)
+    return pipe
+
+
+@pytest.fixture
+def transformer(monkeypatch):
+    """モデルは読み込み済み扱いにし、推論結果を固定する。"""
+    calls = []
+
+    def fake_predict(query, top_k=2):
+        calls.append(query)
+        return [("カフェ", 0.9)]
+
+    monkeypatch.setattr(api, "_load_transformer", lambda: (object(), object()))
+    monkeypatch.setattr(api, "_predict_labels", fake_predict)
+    return calls
+
+
+def _stats():
+    stats = latency_budget.degraded_stats()
+    return stats["responses"], dict(stats["reasons"])
+
+
+def _analyze(query, budget_ms=None):
+    return api.analyze(
+        api.AnalyzeReq(query=query),
+        x_request_id=None,
+        x_debug_trace=None,
+        x_latency_budget_ms=budget_ms,
+        trace=None,
+    )
+
+
+def test_model_is_not_loaded_on_event_loop(monkeypatch, shared_cache):
+    loaded_on = []
+
+    def fake_load():
+        loaded_on.append(threading.current_thread() is threading.main_thread())
+        api._TR_VERSION = "model-v1"
+        shared_cache.set_versions(api._TR_VERSION, api.DICT_VERSION)
+        return object(), object()
+
+    monkeypatch.setattr(api, "_load_transformer", fake_load)
+    monkeypatch.setattr(api, "_predict_labels", lambda query, top_k=2: [("カフェ", 0.9)])
+
+    first = asyncio.run(_analyze(MISS_QUERY))
+    assert first.status_code == 200
+    assert loaded_on and not any(loaded_on)
+    # 初回で版が確定するので結果は保存され、2 回目は共有キャッシュから返る
+    info = {}
+    second = asyncio.run(api._analyze_query(MISS_QUERY, info))
+    assert info["tier"] == "shared_cache"
+    assert second.body == first.body
+    assert json.loads(first.body)["model_type"] == "transformer"
+
+
+def test_model_version_includes_ner_settings(monkeypatch, tmp_path):
+    model_dir = tmp_path / "clf"
+    model_dir.mkdir()
+    (model_dir / "config.json").write_text("{}")
+    monkeypatch.delenv("NER_MIN_CONF", raising=False)
+    base = api._model_version(str(model_dir))
+    monkeypatch.setenv("NER_MIN_CONF", "0.9")
+    assert api._model_version(str(model_dir)) != base
+
+
+def test_failed_model_load_is_tried_once_and_not_measured(monkeypatch):
+    calls = []
+
+    def failing_load():
+        calls.append(1)
+        return None, None
+
+    monkeypatch.setattr(api, "_load_transformer", failing_load)
+    info = {}
+    response = asyncio.run(api._analyze_query(MISS_QUERY, info))
+    assert response.status_code == 400
+    assert info["tier"] == "transformer"
+    assert len(calls) == 1
+    assert latency_budget.COSTS.estimate("transformer") is None
+
+
+def test_skipped_transformer_returns_degraded_body_and_header(transformer):
+    latency_budget.COSTS.observe("transformer", 1000.0)
+    responses, reasons = _stats()
+
+    response = asyncio.run(_analyze(MISS_QUERY, budget_ms="50"))
+
+    assert response.status_code == 400
+    assert response.headers["X-Degraded"] == "1"
+    assert response.headers["X-Request-ID"]
+    body = json.loads(response.body)
+    assert body["degraded"] is True
+    assert body["degraded_reasons"] == ["transformer_skipped"]
+    assert body["error"]["code"] == 400
+    assert transformer == []
+    new_responses, new_reasons = _stats()
+    assert new_responses == responses + 1
+    assert new_reasons["transformer_skipped"] == reasons.get("transformer_skipped", 0) + 1
+
+
+def test_busy_slot_times_out_as_queue_timeout(transformer):
+    responses, reasons = _stats()
+
+    async def run():
+        assert await api._TR_QUEUE.acquire()
+        try:
+            return await _analyze(MISS_QUERY, budget_ms="100")
+        finally:
+            api._TR_QUEUE.release()
+
+    response = asyncio.run(run())
+
+    assert response.headers["X-Degraded"] == "1"
+    assert json.loads(response.body)["degraded_reasons"] == ["transformer_queue_timeout"]
+    assert transformer == []
+    assert api._TR_QUEUE.waiting == 0
+    new_responses, new_reasons = _stats()
+    assert new_responses == responses + 1
+    assert new_reasons["transformer_queue_timeout"] == reasons.get("transformer_queue_timeout", 0) + 1
+
+
+def test_dictionary_hit_skips_ner_over_budget(ner_pipe):
+    latency_budget.COSTS.observe("ner", 1000.0)
+    responses, reasons = _stats()
+
+    response = asyncio.run(_analyze("カフェ", budget_ms="50"))
+
+    assert response.status_code == 200
+    assert response.headers["X-Degraded"] == "1"
+    body = json.loads(response.body)
+    assert body["searchTerms"] == [{"tags": [{"key": "amenity", "value": "cafe"}]}]
+    assert body["degraded_reasons"] == ["ner_skipped"]
+    assert ner_pipe.calls == 0
+    new_responses, new_reasons = _stats()
+    assert new_responses == responses + 1
+    assert new_reasons["ner_skipped"] == reasons.get("ner_skipped", 0) + 1
+
+
+def test_response_within_budget_is_not_degraded(transformer, ner_pipe):
+    responses, _ = _stats()
+
+    response = asyncio.run(_analyze(MISS_QUERY, budget_ms="10000"))
+
+    assert response.status_code == 200
+    assert "X-Degraded" not in response.headers
+    assert "degraded" not in json.loads(response.body)
+    assert transformer == [MISS_QUERY]
+    assert _stats()[0] == responses
+
+
+def test_degraded_results_are_not_cached(monkeypatch, shared_cache, transformer, ner_pipe):
+    monkeypatch.setattr(api, "_TR_VERSION", "model-v1")
+    shared_cache.set_versions("model-v1", api.DICT_VERSION)
+    # 辞書段の NER だけが予算超過で省略され、Transformer 段は実行される
+    latency_budget.COSTS.observe("ner", 1000.0)
+
+    response = asyncio.run(_analyze(MISS_QUERY, budget_ms="50"))
+
+    assert response.status_code == 200
+    assert json.loads(response.body)["degraded_reasons"] == ["ner_skipped"]
+    assert transformer == [MISS_QUERY]
+    assert shared_cache.get(MISS_QUERY) is None
+
+    asyncio.run(_analyze(MISS_QUERY))
+    assert shared_cache.get(MISS_QUERY) is not None
@@ -0,0 +1,57 @@
+"""事前エンコード済みレスポンスが FastAPI/Starlette の JSONResponse とバイト互換であることを確認する。"""
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from dictionary import KEYWORD_TO_TAGS  # noqa: E402
+from json_responses import ANALYZE_ERROR_BODY, encode_json, search_terms_body, search_terms_response  # noqa: E402
+from query_normalizer import BRAND_LEXICON  # noqa: E402
+
+
+def _brand_default_tags():
+    for spec in BRAND_LEXICON.values():
+        yield [{"key": t.get("key"), "value": t.get("value")} for t in spec.get("default_tags", [])]
+
+
+def _unique_tag_sets():
+    seen = {}
+    for tags in list(KEYWORD_TO_TAGS.values()) + list(_brand_default_tags()):
+        seen.setdefault(id(tags), tags)
+    return list(seen.values())
+
+
+@pytest.mark.parametrize("tags", _unique_tag_sets())
+def test_search_terms_body_matches_json_response(tags):
+    hit = [{"tags": tags}]
+    assert search_terms_body(hit) == JSONResponse({"searchTerms": hit}).body
+
+
+def test_search_terms_response_for_merged_brand_tags():
+    hit = [{"tags": [{"key": "amenity", "value": "cafe"}, {"key": "shop", "value": "convenience"}]}]
+    response = search_terms_response(hit)
+    assert response.body == JSONResponse({"searchTerms": hit}).body
+    assert response.media_type == "application/json"
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        {"error": {"code": 400, "message": "解析不能なキーワードです。"}},
+        {
+            "searchTerms": [{"tags": [{"key": "amenity", "value": "restaurant"}, {"key": "cuisine", "value": "ramen"}]}],
+            "predicted_label": "ラーメン",
+            "matched_term": "ラーメン",
+            "score": 0.8734,
+            "model_type": "transformer",
+        },
+    ],
+)
+def test_encode_json_matches_json_response(content):
+    assert encode_json(content) == JSONResponse(content).body
+
+
+def test_error_body_matches_json_response():
+    assert ANALYZE_ERROR_BODY == JSONResponse({"error": {"code": 400, "message": "解析不能なキーワードです。"}}).body
@@ -0,0 +1,70 @@
+"""レイテンシ予算・推論キュー・縮退カウンタを確認する。"""
+
+import asyncio
+
+import pytest
+
+import latency_budget
+from latency_budget import InferenceQueue, LatencyBudget, StageCostEstimator
+
+
+@pytest.fixture(autouse=True)
+def fresh_costs(monkeypatch):
+    monkeypatch.setattr(latency_budget, "COSTS", StageCostEstimator())
+
+
+def test_acquire_times_out_only_while_waiting():
+    async def run():
+        q = InferenceQueue(1)
+        assert await q.acquire(timeout_s=0.05)
+        assert not await q.acquire(timeout_s=0.05)
+        assert q.waiting == 0 and q.active == 1
+        q.release()
+        assert await q.acquire(timeout_s=0.05)
+        q.release()
+
+    asyncio.run(run())
+
+
+def test_free_slot_is_taken_even_without_time_left():
+    async def run():
+        q = InferenceQueue(1)
+        assert await q.acquire(timeout_s=0.0)
+        assert not await q.acquire(timeout_s=-0.5)
+        q.release()
+        assert await q.acquire(timeout_s=-0.5)
+        q.release()
+
+    asyncio.run(run())
+
+
+def test_budget_skips_stage_when_estimate_exceeds_remaining():
+    latency_budget.COSTS.observe("transformer", 80.0)
+    budget = LatencyBudget(50.0)
+    with latency_budget.budget_scope(budget):
+        assert not latency_budget.allow_stage("transformer", "transformer_skipped")
+    assert budget.degraded == ["transformer_skipped"]
+
+
+def test_unknown_estimate_is_allowed():
+    budget = LatencyBudget(50.0)
+    with latency_budget.budget_scope(budget):
+        assert latency_budget.allow_stage("ner", "ner_skipped")
+    assert budget.degraded == []
+
+
+def test_parse_budget_ms(monkeypatch):
+    monkeypatch.delenv("ANALYZE_LATENCY_BUDGET_MS", raising=False)
+    assert latency_budget.parse_budget_ms(None) is None
+    assert latency_budget.parse_budget_ms("120") == 120.0
+    assert latency_budget.parse_budget_ms("0") is None
+    assert latency_budget.parse_budget_ms("abc") is None
+    monkeypatch.setenv("ANALYZE_LATENCY_BUDGET_MS", "80")
+    assert latency_budget.parse_budget_ms(None) == 80.0
+    # 読めないヘッダーは既定の予算に戻す
+    assert latency_budget.parse_budget_ms("abc") == 80.0
+    assert latency_budget.parse_budget_ms("nan") == 80.0
+    assert latency_budget.parse_budget_ms("120") == 120.0
+    assert latency_budget.parse_budget_ms("0") is None
+    monkeypatch.setenv("ANALYZE_LATENCY_BUDGET_MS", "oops")
+    assert latency_budget.parse_budget_ms(None) is None
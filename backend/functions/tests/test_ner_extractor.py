@@ -0,0 +1,97 @@
+"""NER パイプライン呼び出しの直列化と、NER の版（キャッシュキー用）を確認する。"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import latency_budget
+import ner_extractor
+from latency_budget import LatencyBudget, StageCostEstimator, budget_scope
+
+
+class _FakePipeline:
+    """同時に呼ばれたら失敗する（fast tokenizer の "Already borrowed" 相当）。"""
+
+    def __init__(self) -> None:
+        self.active = 0
+        self.calls = 0
+        self.overlapped = False
+        self._lock = threading.Lock()
+
+    def __call__(self, query):
+        with self._lock:
+            self.active += 1
+            self.calls += 1
+            if self.active > 1:
+                self.overlapped = True
+        try:
+            time.sleep(0.02)
+            if self.overlapped:
+                raise RuntimeError("Already borrowed")
+            return [{"entity_group": "BRAND", "word": query, "score": 0.9}]
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def fake_pipe(monkeypatch):
+    pipe = _FakePipeline()
+    monkeypatch.setattr(latency_budget, "COSTS", StageCostEstimator())
+    monkeypatch.setattr(ner_extractor, "_NER_PIPELINE", pipe)
+    monkeypatch.setattr(ner_extractor, "_NER_SOURCE", "transformer:fake")
+    return pipe
+
+
+def _extract(query):
+    return ner_extractor.extract_brands_and_categories(query, {}, lambda s: s.lower())
+
+
+def test_dictionary_and_transformer_tier_ner_do_not_overlap(fake_pipe):
+    results = {}
+
+    def transformer_tier():
+        # Transformer 段はスレッドプールで予算を外して実行される
+        with budget_scope(None):
+            for i in range(5):
+                results[f"t{i}"] = _extract(f"t{i}")
+
+    worker = threading.Thread(target=transformer_tier)
+    worker.start()
+    # 辞書段はイベントループのスレッドで予算付きで実行される
+    with budget_scope(LatencyBudget(10_000)):
+        for i in range(5):
+            results[f"d{i}"] = _extract(f"d{i}")
+    worker.join()
+
+    assert fake_pipe.calls == 10
+    assert not fake_pipe.overlapped
+    for query, (brands, _, source) in results.items():
+        assert brands == [query]
+        assert source == "transformer:fake"
+
+
+def test_ner_model_version_tracks_model_and_threshold(monkeypatch, tmp_path):
+    model_dir = tmp_path / "ner"
+    model_dir.mkdir()
+    weights = model_dir / "model.safetensors"
+    weights.write_bytes(b"v1")
+    monkeypatch.setenv("NER_MODEL_DIR", str(model_dir))
+    monkeypatch.delenv("NER_MIN_CONF", raising=False)
+    monkeypatch.delenv("NER_ENABLE_TRANSFORMER", raising=False)
+
+    base = ner_extractor.ner_model_version()
+    assert str(model_dir) in base
+
+    monkeypatch.setenv("NER_MIN_CONF", "0.6")
+    assert ner_extractor.ner_model_version() != base
+    monkeypatch.delenv("NER_MIN_CONF")
+
+    mtime = weights.stat().st_mtime
+    os.utime(weights, (mtime + 10, mtime + 10))
+    assert ner_extractor.ner_model_version() != base
+
+    monkeypatch.setenv("NER_ENABLE_TRANSFORMER", "0")
+    assert ner_extractor.ner_model_version().startswith("lexicon|")
@@ -0,0 +1,56 @@
+"""構造化ロガーの出力形式と、キューが満杯のときの破棄を確認する。"""
+
+import json
+import logging
+import queue
+
+import request_log
+from request_log import _JsonFormatter, _StructuredQueueHandler
+
+
+def _emit_through_queue(log_call):
+    q = queue.SimpleQueue()
+    logger = logging.getLogger("osmtag.test_request_log")
+    logger.handlers = [_StructuredQueueHandler(q)]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    log_call(logger)
+    return json.loads(_JsonFormatter().format(q.get_nowait()))
+
+
+def test_exception_is_a_separate_field():
+    def log_call(logger):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception("failed %s", "here", extra={"fields": {"request_id": "abc"}})
+
+    entry = _emit_through_queue(log_call)
+    assert entry["message"] == "failed here"
+    assert entry["request_id"] == "abc"
+    assert entry["severity"] == "ERROR"
+    assert "ZeroDivisionError" in entry["exception"]
+    assert "Traceback" not in entry["message"]
+
+
+def test_plain_record_has_no_exception_field():
+    entry = _emit_through_queue(lambda logger: logger.info("ok", extra={"fields": {"status": 200}}))
+    assert entry["message"] == "ok"
+    assert entry["status"] == 200
+    assert "exception" not in entry
+
+
+def test_full_queue_drops_and_counts_without_blocking():
+    q = queue.Queue(maxsize=1)
+    logger = logging.getLogger("osmtag.test_request_log_full")
+    logger.handlers = [_StructuredQueueHandler(q)]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    before = request_log.dropped_log_records()
+
+    for i in range(3):
+        logger.info("record %d", i)
+
+    assert request_log.dropped_log_records() == before + 2
+    assert q.get_nowait().getMessage() == "record 0"
+    assert q.empty()
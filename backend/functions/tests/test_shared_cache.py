@@ -0,0 +1,127 @@
+"""共有結果キャッシュ（memory / sqlite バックエンド）のヒット・ミス・追い出し・失効を確認する。"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from shared_cache import MemoryBackend, SharedResultCache, SqliteBackend
+
+BODY = '{"searchTerms":[{"tags":[{"key":"amenity","value":"cafe"}]}]}'.encode("utf-8")
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def factory(max_entries=100, ttl_s=60.0):
+        if request.param == "memory":
+            backend = MemoryBackend(max_entries, ttl_s)
+        else:
+            backend = SqliteBackend(str(tmp_path / "cache.db"), max_entries, ttl_s)
+        cache = SharedResultCache(backend)
+        cache.set_versions("model-v1", "dict-v1")
+        return cache
+
+    return factory
+
+
+def test_hit_and_miss(make_cache):
+    cache = make_cache()
+    assert cache.get("カフェ") is None
+    cache.set("カフェ", 200, BODY)
+    assert cache.get("カフェ") == (200, BODY)
+    assert cache.get("ラーメン") is None
+
+
+def test_error_responses_keep_status(make_cache):
+    cache = make_cache()
+    cache.set("???", 400, b'{"error":{}}')
+    assert cache.get("???") == (400, b'{"error":{}}')
+
+
+def test_ttl_expiry(make_cache):
+    cache = make_cache(ttl_s=0.05)
+    cache.set("カフェ", 200, BODY)
+    time.sleep(0.1)
+    assert cache.get("カフェ") is None
+
+
+def test_version_change_invalidates(make_cache):
+    cache = make_cache()
+    cache.set("カフェ", 200, BODY)
+    cache.set_versions("model-v2", "dict-v1")
+    assert cache.get("カフェ") is None
+    cache.set_versions("model-v2", "dict-v2")
+    assert cache.get("カフェ") is None
+    cache.set_versions("model-v1", "dict-v1")
+    assert cache.get("カフェ") == (200, BODY)
+
+
+def test_memory_lru_eviction():
+    cache = SharedResultCache(MemoryBackend(max_entries=2, ttl_s=60.0))
+    cache.set_versions("m", "d")
+    cache.set("a", 200, b"A")
+    cache.set("b", 200, b"B")
+    assert cache.get("a") == (200, b"A")  # a を最近使ったことにする
+    cache.set("c", 200, b"C")
+    assert cache.get("b") is None
+    assert cache.get("a") == (200, b"A")
+    assert cache.get("c") == (200, b"C")
+
+
+def test_sqlite_eviction_bounds_size(tmp_path):
+    path = tmp_path / "cache.db"
+    backend = SqliteBackend(str(path), max_entries=10, ttl_s=60.0)
+    cache = SharedResultCache(backend)
+    cache.set_versions("m", "d")
+    for i in range(SqliteBackend._EVICT_EVERY):
+        cache.set(f"q{i}", 200, b"x")
+    (count,) = sqlite3.connect(path).execute("SELECT COUNT(*) FROM cache").fetchone()
+    assert count == 10
+    assert cache.get(f"q{SqliteBackend._EVICT_EVERY - 1}") == (200, b"x")
+    assert cache.get("q0") is None
+
+
+def test_sqlite_shared_between_instances(tmp_path):
+    path = str(tmp_path / "cache.db")
+    writer = SharedResultCache(SqliteBackend(path, 100, 60.0))
+    reader = SharedResultCache(SqliteBackend(path, 100, 60.0))
+    for cache in (writer, reader):
+        cache.set_versions("m", "d")
+    writer.set("カフェ", 200, BODY)
+    assert reader.get("カフェ") == (200, BODY)
+
+
+def test_sqlite_setup_waits_for_locked_database(tmp_path):
+    path = str(tmp_path / "cache.db")
+    # 他のワーカーがスキーマ作成中でデータベースをロックしている状態
+    holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN EXCLUSIVE")
+    release = threading.Timer(0.3, holder.execute, args=("COMMIT",))
+    release.start()
+    try:
+        backend = SqliteBackend(path, 100, 60.0)
+    finally:
+        release.join()
+        holder.close()
+    cache = SharedResultCache(backend)
+    cache.set_versions("m", "d")
+    cache.set("カフェ", 200, BODY)
+    assert cache.get("カフェ") == (200, BODY)
+    conn = sqlite3.connect(path)
+    (mode,) = conn.execute("PRAGMA journal_mode").fetchone()
+    conn.close()
+    assert mode == "wal"
+
+
+def test_backend_errors_are_misses():
+    class Broken:
+        def get(self, key):
+            raise ConnectionError("down")
+
+        def set(self, key, value):
+            raise ConnectionError("down")
+
+    cache = SharedResultCache(Broken())
+    cache.set("カフェ", 200, BODY)
+    assert cache.get("カフェ") is None
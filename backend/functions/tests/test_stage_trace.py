@@ -0,0 +1,58 @@
+"""ステージトレースとプロファイルの排他を確認する。"""
+
+import threading
+
+import pytest
+
+import stage_trace
+
+
+@pytest.fixture(autouse=True)
+def trace_enabled(monkeypatch):
+    monkeypatch.setattr(stage_trace, "TRACE_ENABLED", True)
+
+
+def test_stage_is_noop_without_trace():
+    with stage_trace.stage("normalize"):
+        pass
+    stage_trace.note("dictionary_candidates", candidates=[])
+
+
+def test_stages_are_recorded():
+    with stage_trace.tracing() as trace:
+        with stage_trace.stage("normalize"):
+            pass
+        stage_trace.note("dictionary_candidates", candidates=["カフェ"], matched="カフェ")
+    stages = trace.to_dict()["stages"]
+    assert stages[0]["stage"] == "normalize" and "ms" in stages[0]
+    assert stages[1] == {"note": "dictionary_candidates", "candidates": ["カフェ"], "matched": "カフェ"}
+
+
+def test_profile_is_taken_in_worker_thread():
+    with stage_trace.tracing(profile=True) as trace:
+        import contextvars
+
+        ctx = contextvars.copy_context()
+
+        def work():
+            with stage_trace.profiled():
+                sum(range(1000))
+
+        t = threading.Thread(target=ctx.run, args=(work,))
+        t.start()
+        t.join()
+    assert trace.profile and "function calls" in trace.profile
+
+
+def test_only_one_profile_per_worker():
+    with stage_trace.tracing(profile=True) as first:
+        with stage_trace.tracing(profile=True) as second:
+            with stage_trace.profiled():
+                pass
+        assert first.profiling
+        assert not second.profiling
+        assert second.profile is None
+        assert {"note": "profile_busy"} in second.events
+    # 解放後は再びプロファイルできる
+    with stage_trace.tracing(profile=True) as third:
+        assert third.profiling
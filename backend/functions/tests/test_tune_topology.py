@@ -0,0 +1,60 @@
+"""tune_topology の推奨ロジックと失敗時の扱いを確認する。"""
+
+import queue
+
+from tune_topology import _collect, recommend
+
+
+class _FakeProc:
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+
+
+def _row(workers, threads, batch_size, qps, p99):
+    return {
+        "workers": workers,
+        "intra_op_threads": threads,
+        "inter_op_threads": 1,
+        "batch_size": batch_size,
+        "throughput_qps": qps,
+        "p50_ms": p99 / 2,
+        "p99_ms": p99,
+    }
+
+
+def test_recommend_ignores_batched_rows():
+    results = [
+        _row(2, 2, 1, qps=40.0, p99=80.0),
+        _row(4, 1, 1, qps=55.0, p99=120.0),
+        _row(1, 4, 4, qps=200.0, p99=90.0),
+    ]
+    best = recommend(results, target_p99_ms=150.0)
+    assert best["batch_size"] == 1
+    assert (best["workers"], best["intra_op_threads"]) == (4, 1)
+
+
+def test_recommend_falls_back_to_lowest_p99():
+    results = [_row(1, 1, 1, qps=10.0, p99=300.0), _row(2, 1, 1, qps=20.0, p99=250.0)]
+    assert recommend(results, target_p99_ms=100.0)["workers"] == 2
+
+
+def test_recommend_without_unbatched_rows():
+    assert recommend([_row(1, 1, 4, qps=10.0, p99=50.0)], target_p99_ms=100.0) is None
+
+
+def test_collect_fails_fast_on_dead_worker():
+    q = queue.Queue()
+    q.put((0, True))
+    procs = [_FakeProc(None), _FakeProc(1)]
+    assert _collect(q, procs, count=2, timeout_s=30.0) is None
+
+
+def test_collect_times_out_on_silent_worker():
+    assert _collect(queue.Queue(), [_FakeProc(None)], count=1, timeout_s=0.1) is None
+
+
+def test_collect_returns_reports_from_finished_workers():
+    q = queue.Queue()
+    q.put((0, [1.0], 1))
+    q.put((1, [2.0], 1))
+    assert len(_collect(q, [_FakeProc(0), _FakeProc(0)], count=2, timeout_s=5.0)) == 2